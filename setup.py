@@ -7,7 +7,7 @@ setup(
     author='Ryan Richholt',
     author_email='rrichholt@tgen.org',
     url='https://github.com/ryanrichholt/tidyss',
-    #python_requires=">=3.0",
+    python_requires=">=3.6",
     packages=['tidyss'],
     entry_points={
         'console_scripts': [
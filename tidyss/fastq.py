@@ -1,108 +1,363 @@
 import os
 import sys
+import io
 import re
-import gzip
+import shutil
+import subprocess
+import threading
 import argparse
 import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from ruamel import yaml
 
+# Prefer the libyaml backed dumper/loader
+try:
+    from ruamel.yaml import CSafeDumper as _Dumper, CSafeLoader as _Loader
+except ImportError:
+    from ruamel.yaml import SafeDumper as _Dumper, SafeLoader as _Loader
+
+# ISA-L accelerated drop-in for gzip, if it's installed
+try:
+    from isal import igzip as _gzip
+except ImportError:
+    import gzip as _gzip
+
+# Rust backed json serializer, if it's installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_BLOCK_SIZE = 128 * 1024
+_NL = ord('\n')
+_FASTQ_EXTS = ('.fastq', '.fastq.gz', '.fq', '.fq.gz')
+
+
+_FASTQ_RE = re.compile(r"(?P<name>.*)(?P<extension>\.fastq|\.fastq\.gz|\.fq|\.fq\.gz)$")
+_ILLUMINA_FASTQ_RE = re.compile(r"(?P<name>.+?)_?(?P<barcode>[NACTG]{3,30})?_?(?P<lane>L\d{3})?(_)?(?P<read>R\d)?_?(?P<set>\d{3})(?P<extension>\.fastq|\.fastq\.gz)$")
+_ILLUMINA_SEQID_V1_RE = re.compile(r"@(?P<instrument>[a-zA-Z0-9_-]*):(?P<lane>\d*):(?P<tile>\d*):(?P<x_pos>\d*):(?P<y_pos>\d*)(?P<barcode>#\d|[NACTG]*)\/(?P<read>\d)")
+_ILLUMINA_SEQID_V2_RE = re.compile(r"@(?P<instrument>[a-zA-Z0-9_-]*):(?P<run_number>\d*):(?P<flowcellID>[a-zA-Z0-9]*):(?P<lane>\d*):(?P<tile>\d*):(?P<x_pos>\d*):(?P<y_pos>\d*)\s(?P<read>\d*):(?P<is_filtered>[YN]):(?P<control_number>\d*):(?P<barcode>[NACTG]*)")
+
 
 class FastqFilename:
-    pattern = re.compile(r"(?P<name>.*)(?P<extension>\.fastq|\.fastq\.gz|\.fq|fq\.gz)$")
+    pattern = _FASTQ_RE
     match = pattern.match
 
 
 class IlluminaFastqFilename:
-    pattern = re.compile(r"(?P<name>.+?)_?(?P<barcode>[NACTG]{3,30})?_?(?P<lane>L\d{3})?(_)?(?P<read>R\d)?_?(?P<set>\d{3})(?P<extension>\.fastq|\.fastq\.gz)$")
+    pattern = _ILLUMINA_FASTQ_RE
     match = pattern.match
 
 
 class IlluminaSeqIdV1:
-    pattern = re.compile(r"@(?P<instrument>[a-zA-Z0-9_-]*):(?P<lane>\d*):(?P<tile>\d*):(?P<x_pos>\d*):(?P<y_pos>\d*)(?P<barcode>#\d|[NACTG]*)\/(?P<read>\d)")
+    pattern = _ILLUMINA_SEQID_V1_RE
     match = pattern.match
 
 
 class IlluminaSeqIdV2:
-    pattern = re.compile(r"@(?P<instrument>[a-zA-Z0-9_-]*):(?P<run_number>\d*):(?P<flowcellID>[a-zA-Z0-9]*):(?P<lane>\d*):(?P<tile>\d*):(?P<x_pos>\d*):(?P<y_pos>\d*)\s(?P<read>\d*):(?P<is_filtered>[YN]):(?P<control_number>\d*):(?P<barcode>[NACTG]*)")
+    pattern = _ILLUMINA_SEQID_V2_RE
     match = pattern.match
 
 
 filename_patterns = (IlluminaFastqFilename, FastqFilename)
 seqid_patterns = (IlluminaSeqIdV2, IlluminaSeqIdV1)
 
+_DNA_TABLE = str.maketrans('', '', 'NACTG')
+
+
+# Like the regex's \d, str.isdecimal accepts any Unicode decimal digit
+def _is_lane(t):
+    return len(t) == 4 and t[0] == 'L' and t[1:].isdecimal()
+
+
+def _is_read(t):
+    return len(t) == 2 and t[0] == 'R' and t[1].isdecimal()
+
+
+def _is_dna(t):
+    # Deleting every base leaves nothing iff t is all bases
+    return not t.translate(_DNA_TABLE)
+
+
+def _is_barcode(t):
+    return 3 <= len(t) <= 30 and _is_dna(t)
+
+
+def parse_illumina_name(fn):
+    """ Parse an Illumina style fastq filename without the regex engine.
+    Splits the name on underscores and classifies the trailing tokens,
+    falling back to IlluminaFastqFilename for anything else.
+    :param fn: Basename of a fastq file
+    :return: dict of IlluminaFastqFilename groups, or None if no match
+    """
+    if fn.endswith('.fastq.gz'):
+        extension = '.fastq.gz'
+    elif fn.endswith('.fastq'):
+        extension = '.fastq'
+    else:
+        return None
+
+    tokens = fn[:-len(extension)].rsplit('_', 4)
+    seq_set = tokens.pop()
+
+    # Trailing tokens must appear in the order barcode, lane, read, set
+    if tokens and len(seq_set) == 3 and seq_set.isdecimal():
+        read = lane = barcode = None
+        first = 3
+        if len(tokens) > 1 and _is_read(tokens[-1]):
+            read = tokens.pop()
+            first = 2
+        if len(tokens) > 1 and _is_lane(tokens[-1]):
+            lane = tokens.pop()
+            first = 1
+        if len(tokens) > 1 and _is_barcode(tokens[-1]):
+            barcode = tokens.pop()
+            first = 0
+        name = '_'.join(tokens)
+
+        # The regex takes the shortest name, so it would split off any
+        # trailing barcode, lane or read that is not underscore separated.
+        # A barcode needs 3 bases and must leave at least 1 char of name.
+        bases = len(name) - len(name.rstrip('NACTG'))
+        ambiguous = (
+            '' in tokens or '\n' in name
+            or (first > 0 and min(bases, len(name) - 1) >= 3)
+            or (first > 1 and _is_lane(name[-4:]))
+            or (first > 2 and _is_read(name[-2:]))
+        )
+        if not ambiguous:
+            return {'name': name, 'barcode': barcode, 'lane': lane,
+                    'read': read, 'set': seq_set, 'extension': extension}
+
+    groups = _ILLUMINA_FASTQ_RE.match(fn)
+    if groups:
+        return groups.groupdict()
+    return None
+
+
+def _parse_fastq_name(fn):
+    if not fn.endswith(_FASTQ_EXTS):
+        return None
+    groups = _FASTQ_RE.match(fn)
+    if groups:
+        return groups.groupdict()
+    return None
+
+
+# (name, parser) pairs, tried in order by Fastq
+_FILENAME_PARSERS = (
+    (IlluminaFastqFilename.__name__, parse_illumina_name),
+    (FastqFilename.__name__, _parse_fastq_name),
+)
+
+
+def _parse_seqid(seqid):
+    """ Match a seqid against the seqid patterns, in order
+    :param seqid: First line of a fastq
+    :return: (pattern name, groupdict), or (None, None) if no match
+    """
+    for pattern in seqid_patterns:
+        groups = pattern.match(seqid)
+        if groups:
+            return pattern.__name__, groups.groupdict()
+    return None, None
+
+
+ParsedName = namedtuple('ParsedName', 'pattern name lane read barcode')
+
+
+@lru_cache(maxsize=8192)
+def _parse_filename(fn):
+    """ Parse a fastq basename with the first matching filename pattern.
+    Results only depend on the basename, so they are memoized.
+    :param fn: Basename of a fastq file
+    :return: ParsedName, or None if no pattern matches
+    """
+    for pattern_name, parse in _FILENAME_PARSERS:
+        gd = parse(fn)
+        if gd:
+            read = gd.get('read')
+            if read is not None:
+                read = read.strip('R')
+            return ParsedName(pattern_name, gd['name'], gd.get('lane'),
+                              read, gd.get('barcode'))
+    return None
+
+
+def _open_gzip_buffered(path, mode='rb'):
+    """ Open a gzip file behind a _BLOCK_SIZE read buffer """
+    return io.BufferedReader(_gzip.open(path, mode), buffer_size=_BLOCK_SIZE)
+
+
+# Raised when pigz fails to decompress a file
+_BadGzipFile = getattr(_gzip, 'BadGzipFile', OSError)
+
+# Looked up once, not on every length() call
+_PIGZ = shutil.which('pigz')
+
+
+@contextmanager
+def _open_gz_fast(path, mode='rb'):
+    """ Stream a gzip file through pigz if it's on the PATH, so that
+    decompression runs on other cores. Otherwise uses _open_gzip_buffered.
+    A missing or unreadable file raises the same OSError either way, but
+    any pigz failure raises BadGzipFile, including a truncated file where
+    the in-process reader would raise EOFError.
+    """
+    if mode != 'rb':
+        raise ValueError('_open_gz_fast only supports mode "rb", not "%s"' % mode)
+
+    if _PIGZ is None:
+        with _open_gzip_buffered(path, mode) as fp:
+            yield fp
+        return
+
+    # Open here so a missing or unreadable file fails the same either way
+    with open(path, 'rb') as src:
+        try:
+            proc = subprocess.Popen([_PIGZ, '-dc'], stdin=src, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, bufsize=_BLOCK_SIZE)
+        except OSError:
+            proc = None
+
+        if proc is None:
+            with _open_gzip_buffered(path, mode) as fp:
+                yield fp
+            return
+
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            err = proc.stderr.read()
+            proc.stderr.close()
+            returncode = proc.wait()
+
+    if returncode:
+        msg = err.decode(errors='replace').strip() or 'pigz exited with {}'.format(returncode)
+        raise _BadGzipFile('{}: {}'.format(path, msg))
+
+
+class _lazy:
+    """ Computes an attribute on first access and stores it on the instance.
+    Like functools.cached_property, but without its lock. On Python < 3.12
+    that lock is shared by every instance and would serialize file reads.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.attrname = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner, name):
+        self.attrname = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.attrname] = self.func(instance)
+        return value
+
+
+def _seqid_field(group, default=None):
+    """ Fastq attribute resolved lazily from the parsed seqid """
+    def get(self):
+        return self._seqid_groups.get(group, default)
+    return _lazy(get)
+
 
 class Fastq:
+    # Per-thread scratch buffer for length()
+    _tls = threading.local()
+
+    # Attributes reported by __str__
+    _fields = (
+        'barcode', 'control_number', 'fcid', 'filename', 'filename_pattern',
+        'gzipped', 'instrument', 'is_filtered', 'lane', 'name', 'path',
+        'read', 'readgroup', 'run_number', 'seqid', 'seqid_pattern'
+    )
+
     def __init__(self, path):
         """ Fastq container object that resolves metadata from the given path.
         Attempts to extract Name, Lane, and Read from filename, and FCID from
-        the first line of the FASTQ.
+        the first line of the FASTQ. The first line is only read once one of
+        the attributes that depends on it is accessed.
         :param path: Path to a FASTQ file.
         """
-        self.seqid_pattern = None
-        self.instrument = None
-        self.run_number = None
-        self.fcid = None
-        self.is_filtered = None
-        self.control_number = None
-        self.lane = None
-        self.read = None
-        self.barcode = None
-        self.filename_pattern = None
-        self.name = None
-        self.lane = None
-        self.read = None
-
         self.path = path
         self.filename = os.path.basename(self.path)
-        if not FastqFilename.match(self.filename):
-            raise ValueError(' does not match fastq pattern')
+        self.gzipped = self.path.endswith('gz')
 
         # Parse the filename
-        for pattern in filename_patterns:
-            groups = pattern.match(self.filename)
-            if groups:
-                gd = groups.groupdict()
-                self.filename_pattern = pattern.__name__
-                self.name = gd['name']
-                self.lane = gd.get('lane')
-                self.read = gd.get('read')
-                self.barcode = gd.get('barcode')
-                if self.read is not None:
-                    self.read = self.read.strip('R')
-                break
-
-        # Read the first seqid
-        if self.path.endswith('gz'):
-            self.gzipped = True
-            with gzip.open(self.path, 'rb') as fq:
-                self.seqid = fq.readline().decode().strip()
+        parsed = _parse_filename(self.filename)
+        if parsed is None:
+            raise ValueError('{} does not match fastq pattern'.format(self.filename))
+        self._filename_groups = parsed
+        self.filename_pattern = parsed.pattern
+        self.name = parsed.name
+
+    @_lazy
+    def seqid(self):
+        """ The first seqid, read on first access """
+        return self._read_seqid()
+
+    def _read_seqid(self):
+        """ Read the first seqid, a single small read is enough """
+        if self.gzipped:
+            with _gzip.open(self.path, 'rb') as fq:
+                chunk = fq.read(4096)
         else:
-            self.gzipped = False
-            with open(self.path, 'r') as fq:
-                self.seqid = fq.readline().strip()
-
-        # Parse the seqid
-        for pattern in seqid_patterns:
-            groups = pattern.match(self.seqid)
-            if groups:
-                gd = groups.groupdict()
-                self.seqid_pattern = pattern.__name__
-                self.instrument = gd.get('instrument')
-                self.run_number = gd.get('run_number')
-                self.fcid = gd.get('flowcellID', 'Unknown')
-                self.is_filtered = gd.get('is_filtered')
-                self.control_number = gd.get('control_number')
-                # Overwrite these items, more reliable than filename
-                self.lane = gd.get('lane') or self.lane
-                self.read = gd.get('read') or self.read
-                self.barcode = gd.get('barcode') or self.barcode
-                break
-
-        # Beginnings of a read group tag for this fastq
-        self.readgroup = "{}.{}".format(self.fcid, self.lane)
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                chunk = os.read(fd, 4096)
+            finally:
+                os.close(fd)
+        nl = chunk.find(b'\n')
+        if nl != -1:
+            chunk = chunk[:nl]
+        return chunk.decode().strip()
+
+    @_lazy
+    def _parsed_seqid(self):
+        return _parse_seqid(self.seqid)
+
+    @_lazy
+    def seqid_pattern(self):
+        return self._parsed_seqid[0]
+
+    @_lazy
+    def _seqid_groups(self):
+        return self._parsed_seqid[1] or {}
+
+    instrument = _seqid_field('instrument')
+    run_number = _seqid_field('run_number')
+    fcid = _seqid_field('flowcellID', 'Unknown')
+    is_filtered = _seqid_field('is_filtered')
+    control_number = _seqid_field('control_number')
+
+    # Seqid values are more reliable than the filename
+    @_lazy
+    def lane(self):
+        return self._seqid_groups.get('lane') or self._filename_groups.lane
+
+    @_lazy
+    def read(self):
+        return self._seqid_groups.get('read') or self._filename_groups.read
+
+    @_lazy
+    def barcode(self):
+        return self._seqid_groups.get('barcode') or self._filename_groups.barcode
+
+    @_lazy
+    def readgroup(self):
+        """ Beginnings of a read group tag for this fastq """
+        return "{}.{}".format(self.fcid, self.lane)
 
     def __str__(self):
-        return yaml.dump(self.__dict__, default_flow_style=False)
+        mapping = {field: getattr(self, field) for field in self._fields}
+        return yaml.dump(mapping, Dumper=_Dumper, default_flow_style=False)
 
     def length(self, openfn=None, mode=None):
         """ Get the total number of reads"""
@@ -113,27 +368,50 @@ class Fastq:
         # etc..
         if openfn is None or mode is None:
             if self.gzipped:
-                openfn = gzip.open
-                mode = 'rb'
+                openfn = _open_gz_fast
             else:
                 openfn = open
-                mode = 'r'
+            mode = 'rb'
 
-        i = 0
         with openfn(self.path, mode) as fq:
-            for i, l in enumerate(fq):
-                pass
-        return (i + 1)/4
+            # Text mode handles can't readinto, count their lines instead
+            if not hasattr(fq, 'readinto'):
+                return sum(1 for _ in fq) // 4
+
+            # Count newlines a block at a time, reusing one buffer per thread
+            count = 0
+            last = _NL
+            buf = getattr(Fastq._tls, 'buf', None)
+            if buf is None:
+                buf = Fastq._tls.buf = bytearray(_BLOCK_SIZE)
+            while True:
+                n = fq.readinto(buf)
+                if not n:
+                    break
+                count += buf.count(b'\n', 0, n)
+                last = buf[n - 1]
+
+        # Last record may be missing its trailing newline
+        if last != _NL:
+            count += 1
+        return count // 4
 
 
 def as_yaml(mapping):
     """ Returns mapping object as a pretty yaml string"""
-    return yaml.dump(mapping, default_flow_style=False)
+    return yaml.dump(mapping, Dumper=_Dumper, default_flow_style=False)
 
 
 def as_json(mapping):
     """ Returns mapping object as a pretty json string"""
-    return json.dumps(mapping, indent=4)
+    if orjson is not None:
+        return _as_json_bytes(mapping).decode()
+    return json.dumps(mapping, indent=2, ensure_ascii=False)
+
+
+def _as_json_bytes(mapping):
+    """ Returns mapping object as pretty json bytes, requires orjson"""
+    return orjson.dumps(mapping, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
 
 
 def load_json(path):
@@ -143,11 +421,12 @@ def load_json(path):
 
 def load_yaml(path):
     with open(path, 'r') as fp:
-        return yaml.load(fp.read())
+        return yaml.load(fp, Loader=_Loader)
 
 
 def filter_paths(paths, filter):
-    results = [path for path in paths if filter.match(path)]
+    match = filter.match
+    results = [path for path in paths if match(path)]
     return results
 
 
@@ -155,30 +434,42 @@ def scan_dir(path):
     """ Scan a directory and add any fastqs to samples """
     fastq_paths = []
     abspath = os.path.abspath(os.path.expanduser(path))
-    for dp, dn, filenames in os.walk(abspath):
-        for fn in filenames:
-            if FastqFilename.match(fn):
-                p = os.path.join(dp, fn)
-                fastq_paths.append(p)
+    stack = [abspath]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except OSError:
+            continue
+
+        # Same as os.walk, symlinked dirs are listed but not followed, and
+        # entries that can't be stat'd are treated as files
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+
+            if is_dir:
+                try:
+                    is_symlink = entry.is_symlink()
+                except OSError:
+                    is_symlink = False
+                if not is_symlink:
+                    subdirs.append(entry.path)
+            elif entry.name.endswith(_FASTQ_EXTS) and _FASTQ_RE.match(entry.name):
+                fastq_paths.append(entry.path)
+        stack.extend(reversed(subdirs))
     return fastq_paths
 
 
 def build_samples(fastqs):
     samples = {}
     for fastq in fastqs:
-        if fastq.name not in samples:
-            samples[fastq.name] = {'name': fastq.name}
-
-        if 'name' not in samples[fastq.name]:
-            samples[fastq.name]['name'] = fastq.name
-
-        if 'readgroups' not in samples[fastq.name]:
-            samples[fastq.name]['readgroups'] = {}
-
-        if fastq.readgroup not in samples[fastq.name]['readgroups']:
-            samples[fastq.name]['readgroups'][fastq.readgroup] = {}
-
-        samples[fastq.name]['readgroups'][fastq.readgroup][fastq.read] = fastq.path
+        sample = samples.setdefault(fastq.name, {'name': fastq.name, 'readgroups': {}})
+        readgroup = sample['readgroups'].setdefault(fastq.readgroup, {})
+        readgroup[fastq.read] = fastq.path
 
     return samples
 
@@ -190,7 +481,12 @@ def print_samplesheet(samplesheet, fp, format='json'):
         serializer = as_yaml
     else:
         raise ValueError('Cant print samplesheets with "%s"' % format)
-    fp.write(serializer(samplesheet))
+
+    # Skip the decode/encode round trip on binary file objects
+    if serializer is as_json and orjson is not None and not isinstance(fp, io.TextIOBase):
+        fp.write(_as_json_bytes(samplesheet))
+    else:
+        fp.write(serializer(samplesheet))
     fp.flush()
     fp.close()
 
@@ -242,6 +538,14 @@ def get_args_discover(args=None):
     return args
 
 
+def _load_fastq(path):
+    """ Make a Fastq and read its seqid up front """
+    fastq = Fastq(path)
+    # Resolve the lazy seqid here so the read runs in the worker thread
+    fastq.seqid
+    return fastq
+
+
 def discover(args=None):
     args = get_args_discover(args)
 
@@ -254,19 +558,19 @@ def discover(args=None):
     if args.filter:
         fastq_paths = filter_paths(fastq_paths, args.filter)
 
-    # Make Fastq objects
-    fastqs = [Fastq(path) for path in fastq_paths]
+    # Make Fastq objects, overlapping the reads of each first seqid
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        fastqs = list(ex.map(_load_fastq, fastq_paths))
 
     # Log a summary of what we found
     if not args.quiet:
-        sys.stderr.write('Filename\tSequenceID\tPath\n')
-        for fastq in fastqs:
-            msg = '{filename}\t{seqid}\t{path}\n'.format(
-                filename=fastq.filename_pattern,
-                seqid=fastq.seqid_pattern,
-                path=fastq.path
-            )
-            sys.stderr.write(msg)
+        lines = ['Filename\tSequenceID\tPath\n']
+        lines.extend(
+            f'{fastq.filename_pattern}\t{fastq.seqid_pattern}\t{fastq.path}\n'
+            for fastq in fastqs
+        )
+        sys.stderr.writelines(lines)
         sys.stderr.flush()
 
     # Print a samplesheet if we want to